@@ -0,0 +1,42 @@
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Shared, since decompressing a table of code states would otherwise build
+# a new decompressor for every row
+_decompressor = zstandard.ZstdDecompressor() if zstandard is not None else None
+
+# Every zstd frame starts with these bytes, which lets us tell compressed
+# code apart from code stored as plain text
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def _require_zstandard():
+    if zstandard is None:
+        raise ImportError('The zstandard package is required for compressed code states')
+
+
+def code_compressor(level=3):
+    """ Returns a zstd compressor for use with code_compress.
+    """
+    _require_zstandard()
+    return zstandard.ZstdCompressor(level=level)
+
+
+def code_compress(compressor, code):
+    """ Returns code as a zstd-compressed blob, which code_decompress reverses.
+    """
+    return compressor.compress(code.encode('utf-8'))
+
+
+def code_decompress(code):
+    """ Returns the code stored in a CodeStates Code value as a string,
+    decompressing it if it was stored as a zstd-compressed blob.
+    """
+    if not isinstance(code, bytes):
+        return code
+    if not code.startswith(ZSTD_MAGIC):
+        return code.decode('utf-8')
+    _require_zstandard()
+    return _decompressor.decompress(code).decode('utf-8')
@@ -1,13 +1,14 @@
+import atexit
 import sqlite3
 import pickle
+import hashlib
+from collections import OrderedDict
 import os
+import queue
+import threading
+import time
 from .progsnap import PS2
-
-def get(json_obj, key, default=None):
-    if key in json_obj:
-        return json_obj[key]
-    else:
-        return default
+from .compression import code_compressor, code_compress, code_decompress
 
 CODE_STATES_TABLE = 'CodeStates'
 MAIN_TABLE = 'MainTable'
@@ -17,7 +18,12 @@ SUBJECT_TABLE = 'LinkSubject'
 
 CODE_STATES_TABLE_COLUMNS = {
     'CodeStateID': 'INTEGER PRIMARY KEY',
-    'Code': 'TEXT',
+    # Code is stored as text, or as a zstd-compressed blob when the logger
+    # is created with compress_code=True
+    'Code': 'BLOB',
+    # A fixed-size digest of Code, so deduplication indexes 16 bytes per
+    # code state instead of the full source text
+    'CodeHash': 'BLOB NOT NULL UNIQUE',
 }
 
 MAIN_TABLE_COLUMNS = {
@@ -48,56 +54,183 @@ SUBJECT_TABLE_COLUMNS = {
     'IsInterventionGroup': 'INTEGER',
 }
 
+# The MainTable columns given when logging an event. EventID is the
+# autoincrementing primary key, so it is never part of the INSERT
+_MAIN_INSERT_COLUMNS = tuple(k for k in MAIN_TABLE_COLUMNS if k != PS2.EventID)
+
+
+def _create_table_sql(table_name, column_map):
+    column_text = [f"`{k}` {v}" for k, v in column_map.items()]
+    return f"CREATE TABLE IF NOT EXISTS {table_name} ({','.join(column_text)})"
+
+
+def _code_hash(code):
+    return hashlib.blake2b(code.encode('utf-8'), digest_size=16).digest()
+
+
+# The number of events committed per transaction by log_events; there
+# are diminishing returns for larger batches
+LOG_BATCH_SIZE = 10000
+
+# The maximum number of code states whose IDs SQLiteLogger keeps in memory
+CODE_CACHE_SIZE = 100000
+
+# The maximum number of events waiting for the background writer before
+# log_event blocks
+WRITER_QUEUE_SIZE = 10000
+
+# How often, in seconds, to let SQLite refresh its query planner statistics
+OPTIMIZE_INTERVAL_SECONDS = 900
+
 
 class SQLiteLogger:
     """
     A work-in-progress SQLite logging class that creates a ProgSnap2-formatted
     database. Supports basic logging and updating of data. Does not support
     the whole PS2 specification yet.
+
+    If background_writer is True, log_event only queues the event, and a
+    background thread writes queued events in batches. Call flush to wait
+    for queued events to be written, and close when done logging. A logger
+    that is never closed is closed at interpreter exit, but queued events are
+    lost if the process is killed or exits with os._exit.
     """
 
-    def __init__(self, db_path):
+    def __init__(self, db_path, compress_code=False, background_writer=False):
         dirname = os.path.dirname(os.path.abspath(db_path))
         os.makedirs(dirname, exist_ok=True)
         self.db_path = db_path
+        # A single connection is reused for the lifetime of the logger, so
+        # calls from multiple threads are serialized through this lock
+        self._lock = threading.RLock()
+        self._insert_sql_cache = {}
+        # An LRU map from CodeHash to CodeStateID for code states we've already
+        # stored, since consecutive events very often share the same code.
+        # Keying by the digest keeps snapshots themselves out of memory.
+        self._code_cache = OrderedDict()
+        # Requires the optional zstandard package
+        self._compressor = code_compressor() if compress_code else None
+        self._last_optimize = time.monotonic()
+        self.conn = self._connect()
+        if db_path != ':memory:':
+            # WAL mode is persistent for the database file, so it only needs
+            # to be set once; it lets readers proceed while we write
+            self.conn.execute("PRAGMA journal_mode=WAL")
         self.create_tables()
 
-    # TODO: This should support batch operations but currently does not
-    def _connect(self):
-        return sqlite3.connect(self.db_path)
+        self._queue = None
+        self._writer_thread = None
+        self._writer_error = None
+        # Guards _closed, so no event can be queued after close stops the writer
+        self._close_lock = threading.Lock()
+        self._closed = False
+        if background_writer:
+            self._queue = queue.Queue(maxsize=WRITER_QUEUE_SIZE)
+            self._writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+            self._writer_thread.start()
+            # The writer is a daemon thread, so write anything still queued
+            # before the interpreter exits
+            atexit.register(self.close)
 
-    def _create_table(self, table_name, column_map):
-        column_text = [f"`{k}` {v}" for k, v in column_map.items()]
-        with self._connect() as conn:
-            c = conn.cursor()
-            c.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({','.join(column_text)})")
-            conn.commit()
+    def _connect(self):
+        # isolation_level=None puts the connection in autocommit mode, so
+        # each statement commits unless we explicitly BEGIN a transaction
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        # These PRAGMAs are per-connection, so apply them to each new one
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-65536")
+        return conn
 
-    def create_tables(self):
-        self._create_table(MAIN_TABLE, MAIN_TABLE_COLUMNS)
-        self._create_table(CODE_STATES_TABLE, CODE_STATES_TABLE_COLUMNS)
-        # Not actually used, but helpful to have for clean loading
-        self._create_table(METADATA_TABLE, METADATA_TABLE_COLUMNS)
-        self.__add_metadata()
-        self._create_table(PROBLEM_TABLE, PROBLEM_TABLE_COLUMNS)
-        self._create_table(SUBJECT_TABLE, SUBJECT_TABLE_COLUMNS)
-        self.__add_code_index()
-
-    def __add_code_index(self):
-        with self._connect() as conn:
-            c = conn.cursor()
-            c.execute(f"CREATE INDEX IF NOT EXISTS idx_Code ON {CODE_STATES_TABLE} (Code)")
-            conn.commit()
-
-    def __add_metadata(self):
-        # get the number of rows in the metadata table
-        with self._connect() as conn:
-            c = conn.cursor()
-            c.execute(f"SELECT COUNT(*) FROM {METADATA_TABLE}")
-            count = c.fetchone()[0]
-            if count != 0:
+    def _writer_loop(self):
+        while True:
+            # Wait for an event, then take whatever else has queued up while
+            # we were waiting or writing, so busy periods write in batches
+            batch = [self._queue.get()]
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            # None is the signal from close to stop
+            stop = None in batch
+            events = [event for event in batch if event is not None]
+            try:
+                self.__write_queued(events)
+                self.__maybe_optimize()
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if stop:
                 return
 
+    def __write_queued(self, events):
+        try:
+            self.__log_events(events)
+        except Exception:
+            # The batch was rolled back, so write events one at a time and
+            # only lose the ones that fail
+            for event in events:
+                try:
+                    self.__log_events([event])
+                except Exception as e:
+                    self._writer_error = e
+
+    def __raise_writer_error(self):
+        error = self._writer_error
+        if error is not None:
+            self._writer_error = None
+            raise error
+
+    def flush(self):
+        """Waits until all events queued by log_event have been written, and
+        raises any error the background writer encountered.
+        """
+        if self._queue is not None:
+            self._queue.join()
+        self.__maybe_optimize()
+        self.__raise_writer_error()
+
+    def __optimize(self):
+        # Only refreshes planner statistics, so failing (e.g. because another
+        # connection holds a lock) must never fail the write that preceded it
+        with self._lock:
+            self._last_optimize = time.monotonic()
+            try:
+                self.conn.execute("PRAGMA optimize")
+            except sqlite3.Error:
+                pass
+
+    def __maybe_optimize(self):
+        if time.monotonic() - self._last_optimize > OPTIMIZE_INTERVAL_SECONDS:
+            self.__optimize()
+
+    def close(self):
+        with self._close_lock:
+            self._closed = True
+        if self._writer_thread is not None:
+            self._queue.put(None)
+            self._writer_thread.join()
+            self._writer_thread = None
+            atexit.unregister(self.close)
+        with self._lock:
+            if self.conn is not None:
+                try:
+                    self.__optimize()
+                finally:
+                    self.conn.close()
+                    self.conn = None
+        self.__raise_writer_error()
+
+    def create_tables(self):
+        table_columns = {
+            MAIN_TABLE: MAIN_TABLE_COLUMNS,
+            CODE_STATES_TABLE: CODE_STATES_TABLE_COLUMNS,
+            # Not actually used, but helpful to have for clean loading
+            METADATA_TABLE: METADATA_TABLE_COLUMNS,
+            PROBLEM_TABLE: PROBLEM_TABLE_COLUMNS,
+            SUBJECT_TABLE: SUBJECT_TABLE_COLUMNS,
+        }
         metadata_map = {
             'Version': '8.0',
             'IsEventOrderingConsistent': 1,
@@ -105,73 +238,173 @@ class SQLiteLogger:
             'EventOrderScopeColumns': '',
             'CodeStateRepresentation': 'Sqlite',
         }
-        for key in metadata_map:
-            self.__insert_map(METADATA_TABLE, {
-                'Property': key,
-                'Value': metadata_map[key]
-            })
+        # Only add metadata properties that aren't already present, so this
+        # is safe to run against an existing database
+        metadata_query = (
+            f"INSERT INTO {METADATA_TABLE} (Property, Value) SELECT ?, ? "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {METADATA_TABLE} WHERE Property = ?)"
+        )
+        with self._lock:
+            c = self.conn.cursor()
+            c.execute("BEGIN")
+            try:
+                for table_name, column_map in table_columns.items():
+                    c.execute(_create_table_sql(table_name, column_map))
+                c.executemany(metadata_query, [(k, v, k) for k, v in metadata_map.items()])
+                self.__add_code_hash_column(c)
+                c.execute("COMMIT")
+            except BaseException:
+                c.execute("ROLLBACK")
+                raise
+
+    def __add_code_hash_column(self, c):
+        # Databases created before CodeStates had a CodeHash column need it
+        # added and filled in, since CREATE TABLE IF NOT EXISTS leaves them as-is
+        c.execute(f"PRAGMA table_info({CODE_STATES_TABLE})")
+        if any(column[1] == 'CodeHash' for column in c.fetchall()):
+            return
+        c.execute(f"ALTER TABLE {CODE_STATES_TABLE} ADD COLUMN CodeHash BLOB")
+        c.execute(f"SELECT CodeStateID, Code FROM {CODE_STATES_TABLE} WHERE Code IS NOT NULL ORDER BY CodeStateID")
+        seen = set()
+        updates = []
+        for code_state_id, code in c.fetchall():
+            code_hash = _code_hash(code_decompress(code))
+            # Older databases could contain duplicate code; only the first
+            # copy gets a hash, so the unique index can still be created
+            if code_hash in seen:
+                continue
+            seen.add(code_hash)
+            updates.append((code_hash, code_state_id))
+        c.executemany(f"UPDATE {CODE_STATES_TABLE} SET CodeHash = ? WHERE CodeStateID = ?", updates)
+        c.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_CodeHash ON {CODE_STATES_TABLE} (CodeHash)")
+        # The full-text Code index is replaced by the CodeHash one, so stop
+        # maintaining it on every insert
+        c.execute("DROP INDEX IF EXISTS idx_Code")
+
+    def __insert_sql(self, table_name, columns):
+        # Building the query once per column set means sqlite3 sees the
+        # identical string each time and can reuse its prepared statement
+        key = (table_name, columns)
+        query = self._insert_sql_cache.get(key)
+        if query is None:
+            column_text = '`' + '`,`'.join(columns) + '`'
+            values = ','.join(['?'] * len(columns))
+            query = f"INSERT INTO {table_name} ({column_text}) VALUES ({values})"
+            self._insert_sql_cache[key] = query
+        return query
 
     def __insert_map(self, table_name, column_map):
-        columns = '`' + '`,`'.join(column_map.keys()) + '`'
-        values = ','.join(['?'] * len(column_map))
-        id = None
-        with self._connect() as conn:
-            c = conn.cursor()
-            query = f"INSERT INTO {table_name} ({columns}) VALUES ({values})"
-            # print(query)
+        query = self.__insert_sql(table_name, tuple(column_map))
+        with self._lock:
+            c = self.conn.cursor()
             c.execute(query, tuple(column_map.values()))
-            id = c.lastrowid
-            conn.commit()
-        return id
+            return c.lastrowid
+
+    def __insert_many(self, table_name, columns, rows):
+        query = self.__insert_sql(table_name, columns)
+        with self._lock:
+            c = self.conn.cursor()
+            c.executemany(query, rows)
 
     def clear_table(self, table_name):
-        with self._connect() as conn:
-            c = conn.cursor()
+        with self._lock:
+            c = self.conn.cursor()
             c.execute(f"DELETE FROM {table_name}")
-            conn.commit()
+            if table_name == CODE_STATES_TABLE:
+                self._code_cache.clear()
 
     def execute_query(self, query, args) -> list[any]:
-        with self._connect() as conn:
-            c = conn.cursor()
+        with self._lock:
+            c = self.conn.cursor()
             c.execute(query, args)
-            conn.commit()
             return c.fetchall()
 
     def __get_codestate_id(self, code_state):
-        # TODO: This could be more efficient and concurrency-safe
-        # using INSERT OR IGNORE, with a UNIQUE Code column, but
-        # I'm keeping it this way for now for backwards compatibility
-        result = None
-        with self._connect() as conn:
-            c = conn.cursor()
-            c.execute(f"SELECT CodeStateID FROM {CODE_STATES_TABLE} WHERE Code = ?", (code_state,))
-            result = c.fetchone()
-        if result is None:
-            return self.__insert_map(CODE_STATES_TABLE, {'Code': code_state})
-        return result[0]
+        if code_state is None:
+            return None
+        code_hash = _code_hash(code_state)
+        with self._lock:
+            code_state_id = self._code_cache.get(code_hash)
+            if code_state_id is not None:
+                self._code_cache.move_to_end(code_hash)
+                return code_state_id
+            code = code_state
+            if self._compressor is not None:
+                code = code_compress(self._compressor, code_state)
+            # The no-op update on conflict lets RETURNING give us the existing ID
+            c = self.conn.cursor()
+            c.execute(
+                f"INSERT INTO {CODE_STATES_TABLE} (Code, CodeHash) VALUES (?, ?) "
+                "ON CONFLICT(CodeHash) DO UPDATE SET CodeHash = excluded.CodeHash "
+                "RETURNING CodeStateID",
+                (code, code_hash)
+            )
+            code_state_id = c.fetchone()[0]
+            self._code_cache[code_hash] = code_state_id
+            if len(self._code_cache) > CODE_CACHE_SIZE:
+                self._code_cache.popitem(last=False)
+        return code_state_id
 
     def log_event(self, event_type, row_dict):
         """Logs an event to the MainTable with column values given in the row_dict.
+        With a background writer, the event is queued and written later.
+        """
+        if self._queue is not None:
+            with self._close_lock:
+                self.__check_open()
+                # Copy the row, since callers often reuse their dict
+                self._queue.put((event_type, dict(row_dict)))
+            return
+        self.log_events([(event_type, row_dict)])
+
+    def log_events(self, events):
+        """Logs a list of (event_type, row_dict) events to the MainTable,
+        committing them in batches of LOG_BATCH_SIZE rather than one at a time.
         """
-        code_state = get(row_dict, 'CodeState')
+        self.__check_open()
+        self.__log_events(events)
+        self.__maybe_optimize()
+
+    def __check_open(self):
+        if self._closed:
+            raise sqlite3.ProgrammingError('Cannot log to a closed SQLiteLogger.')
+
+    def __log_events(self, events):
+        for start in range(0, len(events), LOG_BATCH_SIZE):
+            self.__log_batch(events[start:start + LOG_BATCH_SIZE])
+
+    def __log_batch(self, events):
+        with self._lock:
+            c = self.conn.cursor()
+            c.execute("BEGIN")
+            try:
+                rows = []
+                for event_type, row_dict in events:
+                    main_table_map = self.__main_table_map(event_type, row_dict)
+                    rows.append(tuple(main_table_map.values()))
+                self.__insert_many(MAIN_TABLE, _MAIN_INSERT_COLUMNS, rows)
+                c.execute("COMMIT")
+            except BaseException:
+                c.execute("ROLLBACK")
+                # Code states inserted in this batch no longer exist
+                self._code_cache.clear()
+                raise
+
+    def __main_table_map(self, event_type, row_dict):
+        code_state = row_dict.get('CodeState')
         code_state_id = self.__get_codestate_id(code_state)
-        main_table_map = {
-            PS2.EventType: event_type,
-            PS2.CodeStateID: code_state_id,
-            # I haven't gotten order to work, but it's optional so ignoring
-            # "Order": f"(SELECT IFNULL(MAX(`Order`), 0) + 1 FROM {MAIN_TABLE})"
-        }
-        for key in MAIN_TABLE_COLUMNS:
-            if key in main_table_map:
-                continue
-            main_table_map[key] = get(row_dict, key)
-        del main_table_map[PS2.EventID]
+        # Built in _MAIN_INSERT_COLUMNS order, so every row matches one INSERT
+        main_table_map = {key: row_dict.get(key) for key in _MAIN_INSERT_COLUMNS}
+        main_table_map[PS2.EventType] = event_type
+        main_table_map[PS2.CodeStateID] = code_state_id
+        # I haven't gotten order to work, but it's optional so ignoring
+        # main_table_map["Order"] = f"(SELECT IFNULL(MAX(`Order`), 0) + 1 FROM {MAIN_TABLE})"
         # print (main_table_map)
-        self.__insert_map(MAIN_TABLE, main_table_map)
+        return main_table_map
 
     def get_starter_code(self, problem_id):
-        with self._connect() as conn:
-            c = conn.cursor()
+        with self._lock:
+            c = self.conn.cursor()
             c.execute(f"SELECT StarterCode FROM {PROBLEM_TABLE} WHERE ProblemID = ?", (problem_id,))
             result = c.fetchone()
             if result is None:
@@ -179,19 +412,18 @@ class SQLiteLogger:
             return result[0]
 
     def set_starter_code(self, problem_id, starter_code):
-        with self._connect() as conn:
-            c = conn.cursor()
+        with self._lock:
+            c = self.conn.cursor()
             query = f"INSERT OR IGNORE INTO {PROBLEM_TABLE} (ProblemID) VALUES (?);"
             c.execute(query, (problem_id,))
             query = f"UPDATE {PROBLEM_TABLE} SET StarterCode = ? WHERE ProblemID = ?;"
             c.execute(query, (starter_code, problem_id))
-            conn.commit()
 
     def get_or_set_subject_condition(self, subject_id, condition_to_set):
         if subject_id is None:
             return condition_to_set
-        with self._connect() as conn:
-            c = conn.cursor()
+        with self._lock:
+            c = self.conn.cursor()
             c.execute(f"SELECT IsInterventionGroup FROM {SUBJECT_TABLE} WHERE SubjectID = ?", (subject_id,))
             result = c.fetchone()
             if result is None:
@@ -99,16 +99,20 @@ class ProgSnap2Dataset:
         self.main_table = None
         self.metadata_table = None
         self.code_states_table = None
+        self.__metadata = None
+        self.__code_by_id = None
 
 
     def get_main_table(self) -> pd.DataFrame:
         """ Returns a Pandas DataFrame with the main event table for this dataset.
-        The returned table is a copy, so it can be manipulated without consequence.
+        The returned table is shared with the dataset and must not be modified;
+        use get_main_table_copy to get a table that can be manipulated.
         """
         if self.main_table is None:
+            # The table is only sorted here, when first loaded
             self.main_table = self.data_provider.get_main_table()
             if PS2.Order not in self.main_table.columns:
-                return self.main_table.copy()
+                return self.main_table
             if self.get_metadata_property(Metadata.IsEventOrderingConsistent):
                 order_scope = self.get_metadata_property(Metadata.EventOrderScope)
                 if order_scope == 'Global':
@@ -123,7 +127,13 @@ class ProgSnap2Dataset:
                     columns.append('Order')
                     # The result is that _within_ these groups, events are ordered
                     self.main_table.sort_values(by=columns, inplace=True)
-        return self.main_table.copy()
+        return self.main_table
+
+    def get_main_table_copy(self) -> pd.DataFrame:
+        """ Returns a copy of the main event table for this dataset, which can be
+        manipulated without consequence.
+        """
+        return self.get_main_table().copy()
 
     def set_main_table(self, main_table: pd.DataFrame):
         """ Overwrites the main table loaded from the file with the provided table.
@@ -141,14 +151,17 @@ class ProgSnap2Dataset:
     def get_metadata_property(self, property):
         """ Returns the value of a given metadata property in the metadata table
         """
-        if self.metadata_table is None:
-            self.metadata_table = self.data_provider.get_metadata_table()
-
-        values = self.metadata_table[self.metadata_table['Property'] == property]['Value']
-        if len(values) == 1:
-            return values.iloc[0]
-        if len(values) > 1:
-            raise Exception('Multiple values for property: ' + property)
+        if self.__metadata is None:
+            if self.metadata_table is None:
+                self.metadata_table = self.data_provider.get_metadata_table()
+            properties = self.metadata_table['Property']
+            duplicates = properties[properties.duplicated()]
+            if len(duplicates) > 0:
+                raise Exception('Multiple values for property: ' + str(duplicates.iloc[0]))
+            self.__metadata = dict(zip(properties, self.metadata_table['Value']))
+
+        if property in self.__metadata:
+            return self.__metadata[property]
 
         # Default return values as of V6
         if property == Metadata.IsEventOrderingConsistent:
@@ -194,21 +207,31 @@ class ProgSnap2Dataset:
 
     def get_code_for_event_id(self, row_id):
         events = self.get_main_table()
-        code_state_ids = events[events[PS2.EventID == row_id]][PS2.CodeStateID]
+        code_state_ids = events[events[PS2.EventID] == row_id][PS2.CodeStateID]
         code_state_id = ProgSnap2Dataset.__to_one(code_state_ids, 'Multiple rows match that ID.')
         return self.get_code_for_id(code_state_id)
 
     def get_subject_ids(self):
         events = self.get_main_table()
-        return events[PS2.SubjectID].unique()
+        # to_numpy first, so categorical columns still give a plain array
+        return pd.unique(events[PS2.SubjectID].to_numpy())
 
     def get_problem_ids(self):
         events = self.get_main_table()
-        return events[PS2.ProblemID].unique()
+        # to_numpy first, so categorical columns still give a plain array
+        return pd.unique(events[PS2.ProblemID].to_numpy())
+
+    def __get_code_by_id(self):
+        # A Series indexed by CodeStateID, built once, so looking up many code
+        # states is a single hashed reindex rather than a scan per ID
+        if self.__code_by_id is None:
+            code_states = self.get_code_states_table()
+            self.__code_by_id = code_states.set_index(PS2.CodeStateID)[PS2.Code]
+        return self.__code_by_id
 
     def get_trace(self, subject_id, problem_id):
         events = self.get_main_table()
         rows = events[(events[PS2.SubjectID] == subject_id) & (events[PS2.ProblemID] == problem_id)]
-        ids = rows[PS2.CodeStateID].unique()
-        return [self.get_code_for_id(code_state_id) for code_state_id in ids]
-
+        ids = rows[PS2.CodeStateID].drop_duplicates().tolist()
+        codes = self.__get_code_by_id().reindex(ids).astype(object)
+        return codes.where(codes.notna(), None).tolist()
@@ -1,9 +1,98 @@
 from abc import ABC, abstractmethod
 import os
 from os import path
+import numpy as np
 import pandas as pd
 from pandas import DataFrame
 from .progsnap import PS2
+from .compression import code_decompress
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+if njit is not None:
+    @njit(parallel=True, boundscheck=False)
+    def _mask_eq2(a, a_value, b, b_value):
+        out = np.empty(a.shape[0], np.bool_)
+        for i in prange(a.shape[0]):
+            out[i] = a[i] == a_value and b[i] == b_value
+        return out
+else:
+    def _mask_eq2(a, a_value, b, b_value):
+        return (a == a_value) & (b == b_value)
+
+
+def _category_code(categories, value):
+    # Returns the code of value in categories, -1 if it isn't one of them, or
+    # None if value can't be compared as the categories' type
+    try:
+        cast_value = pd.Index([value]).astype(categories.dtype)[0]
+    except (ValueError, TypeError):
+        return None
+    if cast_value != value:
+        return None
+    return categories.get_indexer([cast_value])[0]
+
+
+def _pair_mask(a, a_value, b, b_value):
+    """ Returns a boolean array marking rows where a == a_value and b == b_value,
+    comparing categorical codes rather than values when both columns are categorical.
+    """
+    if isinstance(a.dtype, pd.CategoricalDtype) and isinstance(b.dtype, pd.CategoricalDtype):
+        a_code = _category_code(a.cat.categories, a_value)
+        b_code = _category_code(b.cat.categories, b_value)
+        if a_code is not None and b_code is not None:
+            if a_code < 0 or b_code < 0:
+                return np.zeros(len(a), dtype=bool)
+            return _mask_eq2(a.cat.codes.to_numpy(), a_code, b.cat.codes.to_numpy(), b_code)
+    return ((a == a_value) & (b == b_value)).to_numpy()
+
+
+def _format_floats(table):
+    # pyarrow writes whole floats without '.0', so a float column of whole
+    # numbers would read back as integers. Format floats as text instead,
+    # adding '.0' where needed, as to_csv does.
+    for i, field in enumerate(table.schema):
+        if not pa.types.is_floating(field.type):
+            continue
+        text = pc.cast(table.column(i), pa.string())
+        is_whole = pc.match_substring_regex(text, r'^-?\d+$')
+        text = pc.if_else(is_whole, pc.binary_join_element_wise(text, '.0', ''), text)
+        table = table.set_column(i, field.name, text)
+    return table
+
+
+def _write_csv(df: DataFrame, file_path):
+    # pyarrow's multithreaded C++ CSV writer is much faster than pandas',
+    # but it's optional, so fall back to to_csv without it. Its output differs
+    # from to_csv's only in quoting and booleans: headers and string values
+    # (including formatted floats) are always quoted, and booleans are written
+    # as true/false. Both read back the same with read_csv.
+    if pa is not None:
+        # Write to a temporary file, so a failure part way through doesn't
+        # leave a partial CSV behind
+        temp_path = file_path + '.tmp'
+        try:
+            table = _format_floats(pa.Table.from_pandas(df, preserve_index=False))
+            pacsv.write_csv(table, temp_path)
+            os.replace(temp_path, file_path)
+            return
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            # e.g. object columns holding mixed types, lists or dicts, which
+            # pandas can write
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    df.to_csv(file_path, index=False)
 
 class PS2DataProvider(ABC):
 
@@ -33,6 +122,16 @@ class CSVDataProvider(PS2DataProvider):
     LINK_TABLE_DIR = 'LinkTables'
     CODE_STATES_DIR = 'CodeStates'
     CODE_STATES_TABLE_FILE = os.path.join(CODE_STATES_DIR, 'CodeStates.csv')
+    # Low-cardinality columns are converted to categoricals after loading,
+    # which use far less memory and make equality filters compare integer
+    # codes. Converting after parsing keeps each column's inferred type, so
+    # numeric IDs stay numeric.
+    MAIN_TABLE_CATEGORICAL_COLUMNS = [
+        PS2.SubjectID,
+        PS2.ProblemID,
+        PS2.AssignmentID,
+        PS2.EventType,
+    ]
 
     def __init__(self, directory):
         self.directory = directory
@@ -43,14 +142,28 @@ class CSVDataProvider(PS2DataProvider):
     def path(self, local_path) -> str:
         return path.join(self.directory, local_path)
 
+    # Each table is parsed once and cached, since save_subset is often called
+    # many times on one provider (e.g. once per subject). Callers get shallow
+    # copies, so adding, dropping or sorting columns doesn't touch the cache.
+
     def get_main_table(self):
-        return pd.read_csv(self.path(CSVDataProvider.MAIN_TABLE_FILE))
+        if self.main_table is None:
+            main_table = pd.read_csv(self.path(CSVDataProvider.MAIN_TABLE_FILE), engine='c', memory_map=True)
+            for column in CSVDataProvider.MAIN_TABLE_CATEGORICAL_COLUMNS:
+                if column in main_table.columns:
+                    main_table[column] = main_table[column].astype('category')
+            self.main_table = main_table
+        return self.main_table.copy(deep=False)
 
     def get_code_states_table(self):
-        return pd.read_csv(self.path(CSVDataProvider.CODE_STATES_TABLE_FILE))
+        if self.code_states_table is None:
+            self.code_states_table = pd.read_csv(self.path(CSVDataProvider.CODE_STATES_TABLE_FILE))
+        return self.code_states_table.copy(deep=False)
 
     def get_metadata_table(self):
-        return pd.read_csv(self.path(CSVDataProvider.METADATA_TABLE_FILE))
+        if self.metadata_table is None:
+            self.metadata_table = pd.read_csv(self.path(CSVDataProvider.METADATA_TABLE_FILE))
+        return self.metadata_table.copy(deep=False)
 
     def __link_table_path(self):
         return self.path(CSVDataProvider.LINK_TABLE_DIR)
@@ -71,29 +184,39 @@ class CSVDataProvider(PS2DataProvider):
     def save_subset(self, path, main_table_filterer, copy_link_tables=True):
         os.makedirs(os.path.join(path, CSVDataProvider.CODE_STATES_DIR), exist_ok=True)
         main_table = main_table_filterer(self.get_main_table())
-        main_table.to_csv(os.path.join(path, CSVDataProvider.MAIN_TABLE_FILE), index=False)
+        _write_csv(main_table, os.path.join(path, CSVDataProvider.MAIN_TABLE_FILE))
         code_state_ids = main_table[PS2.CodeStateID].unique()
         code_states = self.get_code_states_table()
         code_states = code_states[code_states[PS2.CodeStateID].isin(code_state_ids)]
-        code_states.to_csv(os.path.join(path, CSVDataProvider.CODE_STATES_DIR, 'CodeStates.csv'), index=False)
-        self.metadata_table.to_csv(os.path.join(path, CSVDataProvider.METADATA_TABLE_FILE), index=False)
+        _write_csv(code_states, os.path.join(path, CSVDataProvider.CODE_STATES_DIR, 'CodeStates.csv'))
+        _write_csv(self.get_metadata_table(), os.path.join(path, CSVDataProvider.METADATA_TABLE_FILE))
 
         if not copy_link_tables:
             return
 
         os.makedirs(os.path.join(path, CSVDataProvider.LINK_TABLE_DIR), exist_ok=True)
 
-        def indexify(x):
-            return tuple(x) if len(x) > 1 else x[0]
-
-        for link_table_name in self.list_link_tables():
-            link_table = self.load_link_table(link_table_name)
+        for link_table_name in self.get_link_table_names():
+            link_table = self.get_link_table(link_table_name)
             columns = [col for col in link_table.columns if col.endswith('ID') and col in main_table.columns]
-            distinct_ids = main_table.groupby(columns).apply(lambda x: True)
-            # TODO: Still need to test this with multi-ID link tables
-            to_keep = [indexify(list(row)) in distinct_ids for index, row in link_table[columns].iterrows()]
-            filtered_link_table = link_table[to_keep]
-            filtered_link_table.to_csv(os.path.join(path, CSVDataProvider.LINK_TABLE_DIR, link_table_name), index=False)
+            if len(columns) == 0:
+                # Nothing links this table to the main table, so keep all of it
+                _write_csv(link_table, os.path.join(path, CSVDataProvider.LINK_TABLE_DIR, link_table_name))
+                continue
+            # Keep only link rows whose ID columns appear together in the main
+            # table. Like a groupby, this ignores main table rows with a
+            # missing ID, so link rows with missing IDs are never kept.
+            distinct_ids = main_table[columns].dropna().drop_duplicates()
+            filtered_link_table = link_table.merge(distinct_ids, on=columns, how='inner')
+            _write_csv(filtered_link_table, os.path.join(path, CSVDataProvider.LINK_TABLE_DIR, link_table_name))
+
+    def save_subset_by_pair(self, path, subject_id, problem_id, copy_link_tables=True):
+        """ Saves the subset of the dataset for a single subject and problem.
+        """
+        def filterer(main_table):
+            mask = _pair_mask(main_table[PS2.SubjectID], subject_id, main_table[PS2.ProblemID], problem_id)
+            return main_table[mask]
+        self.save_subset(path, filterer, copy_link_tables)
 
 import sqlite3
 
@@ -122,7 +245,12 @@ class SQLiteDataProvider(PS2DataProvider):
         return pd.read_sql_query(f"SELECT * FROM {self.main_table}", self.__connect())
 
     def get_code_states_table(self):
-        return pd.read_sql_query(f"SELECT * FROM {self.code_states_table}", self.__connect())
+        code_states = pd.read_sql_query(f"SELECT * FROM {self.code_states_table}", self.__connect())
+        # CodeHash is SQLiteLogger's internal dedup key, not a PS2 column
+        code_states = code_states.drop(columns=['CodeHash'], errors='ignore')
+        # Code may have been stored compressed by SQLiteLogger
+        code_states[PS2.Code] = code_states[PS2.Code].map(code_decompress)
+        return code_states
 
     def get_metadata_table(self):
         return pd.read_sql_query(f"SELECT * FROM {self.metadata_table}", self.__connect())